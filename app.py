@@ -1,29 +1,65 @@
-import mido
+from timesource import *
+STARTED_AT = monotonic_time()
+
 import time
+import mido
 import os
 import serial
 import collections
+import contextlib
+import operator
+import array
+import heapq
+import itertools
+import queue
+import threading
+import signal
+from typing import Callable, NamedTuple
 from controller_config import *
 from colors import *
 from utils import *
 from cvocd import *
+from leds import *
+from ports import *
+from midi_output import *
+from midi_bytes import *
+from realtime import *
+from metrics import *
+from coalesce import *
+from patterns import *
+from snapshots import *
 
 BPM = int(os.environ.get('BPM', 240))
+SPIN_TIME = int(os.environ.get('SPIN_US', 300)) / 1_000_000
+LOOKAHEAD = int(os.environ.get('LOOKAHEAD_MS', 20)) / 1000
+REALTIME = os.environ.get('REALTIME')
+REALTIME_PRIORITY = int(os.environ.get('REALTIME_PRIORITY', 80))
+REALTIME_CPU = int(os.environ['REALTIME_CPU']) if os.environ.get('REALTIME_CPU') else None
+# Knob changes on the current step are sent at most once per this many ms, or once per clock pulse with 'pulse'
+OUTPUT_COALESCE = os.environ.get('OUTPUT_COALESCE_MS', '10')
+OUTPUT_COALESCE_WINDOW = OUTPUT_COALESCE if OUTPUT_COALESCE == 'pulse' else int(OUTPUT_COALESCE) / 1000
+PATTERN_BANK_PATH = os.environ.get('PATTERN_BANK', 'patterns.bin')
+PATTERN_COUNT = 8
+TOTAL_STEPS = 16
+STATE_PATH = os.environ.get('STATE_PATH', 'state.json')
+SNAPSHOT_INTERVAL = 1
+
+# Set up by start_outputs() and create_sequencer(), importing this module has no side effects
+port_manager = None
+midi_out = None
+clock = None
+sequencer = None
+snapshot_writer = None
 
 def send_usb_midi_message(message: mido.Message):
-    try:
-        inport, outport = get_ports()
-        if outport:
-            outport.send(message)
-    except Exception as e:
-        print(e)
-        reset_ports()
-
-def set_led_color(led_index, color):
-    color_byte = color_components_to_color_byte(color)
-    template_index = 0
-    message = mido.Message('sysex', data=[0, 32, 41, 2, 17, 120, template_index, led_index, color_byte])
-    send_usb_midi_message(message)
+    if port_manager is not None:
+        port_manager.send(message)
+
+# LED changes are collected here and sent as one SysEx per template when flushed
+led_frame = LedFrameBuffer(send_usb_midi_message)
+
+def set_led_color(led_index, color, template_index=0):
+    led_frame.set_led_color_byte(led_index, color_components_to_color_byte(color), template_index)
 
 NOTE_CC = 51
 CV1_CC = 52
@@ -35,39 +71,90 @@ RUN_CC = 63
 RESET_CC = 64
 END_OF_SEQUENCE_CC = 65
 
-def send_midi_message(message: mido.Message):
+TRIGGER_ON = control_change_bytes(TRIGGER_CC, 127)
+TRIGGER_OFF = control_change_bytes(TRIGGER_CC, 0)
+GATE_ON = control_change_bytes(GATE_CC, 127)
+GATE_OFF = control_change_bytes(GATE_CC, 0)
+END_OF_SEQUENCE_ON = control_change_bytes(END_OF_SEQUENCE_CC, 127)
+END_OF_SEQUENCE_OFF = control_change_bytes(END_OF_SEQUENCE_CC, 0)
+CV1_BYTES = control_change_table(CV1_CC)
+CV2_BYTES = control_change_table(CV2_CC)
+CV3_BYTES = control_change_table(CV3_CC)
+NOTE_ON_BYTES = note_on_table()
+NOTE_OFF_BYTES = note_off_table()
+
+def send_midi_bytes(data: bytes):
     if midi_out is None:
-        debug_print('OUT:', message)
+        if DEBUG:
+            debug_print('OUT:', mido.Message.from_bytes(data))
     else:
-        midi_out.write(message.bytes())
+        midi_out.send(data, *clock.get_event_context())
 
-if_step_played = lambda played_color: lambda button: played_color if button.is_step_played() else COLORS['OFF']
-
-GATE_LINE_MODES = [
+# Slow path, handy for debugging and one-off messages
+def send_midi_message(message: mido.Message):
+    send_midi_bytes(bytes(message.bytes()))
+
+def flush_output():
+    if midi_out is not None:
+        midi_out.flush()
+    return led_frame.flush()
+
+class Mode(NamedTuple):
+    name: str
+    # Whether a button shows the active color, from the button's active_field
+    is_active: Callable
+    # Color bytes indexed by [is_step_played][is_active]
+    color_bytes: tuple
+    duty_cycle: float | None = None
+    played: bool | None = None
+
+def compile_modes(modes):
+    compiled = []
+    for mode in modes:
+        active_color = color_components_to_color_byte(mode['active_color'])
+        inactive_color = color_components_to_color_byte(mode.get('inactive_color', mode['active_color']))
+        # Modes with an unplayed color show it on steps that aren't played, whether active or not
+        unplayed_color = color_components_to_color_byte(mode['unplayed_color']) if 'unplayed_color' in mode else None
+        compiled.append(Mode(
+            name=mode['name'],
+            is_active=operator.attrgetter(mode['active_field']) if mode['active_field'] else lambda button: True,
+            color_bytes=(
+                (inactive_color, active_color) if unplayed_color is None else (unplayed_color, unplayed_color),
+                (inactive_color, active_color),
+            ),
+            duty_cycle=mode.get('duty_cycle'),
+            played=mode.get('played'),
+        ))
+    return tuple(compiled)
+
+GATE_LINE_MODES = compile_modes([
     {
         'name': 'HALF',
-        'active_color': if_step_played(COLORS['GREEN_3']),
-        'inactive_color': if_step_played(COLORS['GREEN_1']),
+        'active_color': COLORS['GREEN_3'],
+        'inactive_color': COLORS['GREEN_1'],
+        'unplayed_color': COLORS['OFF'],
         'active_field': 'is_gate_active',
         'duty_cycle': 0.5,
     },
     {
         'name': 'TIE',
-        'active_color': if_step_played(COLORS['YELLOW_3']),
-        'inactive_color': if_step_played(COLORS['YELLOW_2']),
+        'active_color': COLORS['YELLOW_3'],
+        'inactive_color': COLORS['YELLOW_2'],
+        'unplayed_color': COLORS['OFF'],
         'active_field': 'is_gate_active',
         'duty_cycle': 1,
     },
     {
         'name': 'SILENT',
-        'active_color': if_step_played(COLORS['OFF']),
-        'inactive_color': if_step_played(COLORS['RED_2']),
+        'active_color': COLORS['OFF'],
+        'inactive_color': COLORS['RED_2'],
+        'unplayed_color': COLORS['OFF'],
         'active_field': 'is_current_step',
         'duty_cycle': 0,
     },
-]
+])
 
-STEP_LINE_MODES = [
+STEP_LINE_MODES = compile_modes([
     {
         'name': 'STEP',
         'active_color': COLORS['GREEN_3'],
@@ -96,9 +183,9 @@ STEP_LINE_MODES = [
         'active_field': 'is_current_step',
         'played': True,
     },
-]
+])
 
-TEST_LINE_MODES = [
+TEST_LINE_MODES = compile_modes([
     {
         'name': 'OFF',
         'active_color': COLORS['RED_3'],
@@ -109,15 +196,20 @@ TEST_LINE_MODES = [
         'active_color': COLORS['GREEN_3'],
         'active_field': None,
     },
-]
+])
 
 class Button:
+    __slots__ = (
+        'midi_channel', 'cc_number', 'cc_value', 'led_index', 'sequencer', 'step_index', 'is_current_step', 'is_gate_active',
+        'on_button_down', 'on_button_up', 'on_step_change', 'modesets', 'active_modeset_name', 'active_modes', 'active_mode',
+    )
+
     def __init__(self, cc_number, led_index, modesets={}, active_modeset_name=None, active_modes={}, cc_value=None, midi_channel=0, is_current_step=False, is_gate_active=False, sequencer=None, step_index=None):
-        controllers.append(self)
         self.midi_channel = midi_channel
         self.cc_number = cc_number
         self.cc_value = cc_value
         self.led_index = led_index
+        add_controller(self)
 
         self.sequencer = sequencer
         self.step_index = step_index
@@ -132,6 +224,8 @@ class Button:
         self.modesets = modesets
         self.active_modeset_name = active_modeset_name
         self.active_modes = {}
+        # The mode shown by the LED, kept up to date by set_active_modeset and set_active_mode_index
+        self.active_mode = None
 
         for modeset_name in modesets:
             self.set_active_mode_index(modeset_name, active_modes[modeset_name] if modeset_name in active_modes else 0)
@@ -149,7 +243,7 @@ class Button:
         return self.active_modes[self.active_modeset_name]
 
     def get_active_mode(self):
-        return self.get_active_modeset()[self.get_active_mode_index()]
+        return self.active_mode
 
     def get_active_mode_index_for_modeset(self, modeset_name: str):
         return self.active_modes[modeset_name]
@@ -159,11 +253,16 @@ class Button:
 
     def set_active_modeset(self, modeset_name: str):
         self.active_modeset_name = modeset_name
-        self.set_led_color(self.get_led_color())
+        self.active_mode = self.get_active_mode_for_modeset(modeset_name)
+        self.set_led_color_byte(self.get_led_color_byte())
 
     def set_active_mode_index(self, modeset_name: str, active_mode_index: int):
         self.active_modes[modeset_name] = active_mode_index
-        self.set_led_color(self.get_led_color())
+        if modeset_name == self.active_modeset_name:
+            self.active_mode = self.get_active_mode_for_modeset(modeset_name)
+        if self.sequencer is not None:
+            self.sequencer.on_mode_change(self, modeset_name)
+        self.set_led_color_byte(self.get_led_color_byte())
 
     def set_next_active_mode(self, modeset_name: str=None):
         if modeset_name is None:
@@ -178,12 +277,7 @@ class Button:
         self.set_active_mode_index(modeset_name, (active_mode_index + 1) % len(modeset))
 
     def is_step_played(self):
-        first_reset_index = self.sequencer.get_first_reset_index()
-        is_after_reset = self.step_index > first_reset_index if first_reset_index is not None else False
-        if is_after_reset:
-            return False
-
-        return self.get_active_mode_for_modeset('step')['played']
+        return self.sequencer is None or self.sequencer.played_steps[self.step_index]
 
     def set_value(self, midi_channel, cc_number, cc_value):
         if midi_channel != self.midi_channel:
@@ -204,7 +298,7 @@ class Button:
     def set_is_current_step(self, is_current_step):
         old_is_current_step = self.is_current_step
         self.is_current_step = is_current_step
-        self.set_led_color(self.get_led_color())
+        self.set_led_color_byte(self.get_led_color_byte())
         if old_is_current_step != is_current_step:
             for callback in self.on_step_change:
                 callback(self)
@@ -213,15 +307,13 @@ class Button:
         old_is_gate_active = self.is_gate_active
         self.is_gate_active = is_gate_active
         if old_is_gate_active != is_gate_active:
-            self.set_led_color(self.get_led_color())
+            self.set_led_color_byte(self.get_led_color_byte())
 
-    def get_led_color(self):
-        active_mode = self.get_active_mode()
-        active_field_value = getattr(self, active_mode['active_field']) if active_mode['active_field'] else True
-        if active_field_value:
-            return callable(active_mode['active_color']) and active_mode['active_color'](self) or active_mode['active_color']
-        else:
-            return callable(active_mode['inactive_color']) and active_mode['inactive_color'](self) or active_mode['inactive_color']
+    def get_led_color_byte(self):
+        mode = self.active_mode
+        if mode is None:
+            return None
+        return mode.color_bytes[self.is_step_played()][mode.is_active(self)]
 
     def set_led_color(self, color=None):
         if self.led_index is None:
@@ -232,6 +324,15 @@ class Button:
 
         set_led_color(self.led_index, color)
 
+    def set_led_color_byte(self, color_byte=None):
+        if self.led_index is None:
+            return
+
+        if color_byte is None:
+            return
+
+        led_frame.set_led_color_byte(self.led_index, color_byte)
+
 class RadioButtons():
     def __init__(self, buttons: list[Button], selected_index=0, selected_color=COLORS['GREEN_3'], unselected_color=COLORS['OFF']):
         self.buttons = buttons
@@ -261,17 +362,27 @@ class RadioButtons():
             else:
                 button.set_led_color(self.unselected_color)
 
+# Controller LED color bytes indexed by [has_value][is_current_step]
+CONTROLLER_COLOR_BYTES = (
+    (color_components_to_color_byte(COLORS['RED_1']), color_components_to_color_byte(COLORS['RED_3'])),
+    (color_components_to_color_byte(COLORS['GREEN_1']), color_components_to_color_byte(COLORS['GREEN_3'])),
+)
+
 class Controller:
-    def __init__(self, cc_number, led_index, cc_value=None, midi_channel=0, is_current_step=False, sequencer=None, step_index=None):
-        controllers.append(self)
+    __slots__ = ('cc_number', 'led_index', 'cc_value', 'midi_channel', 'sequencer', 'step_index', 'step_values', 'is_current_step')
+
+    def __init__(self, cc_number, led_index, cc_value=None, midi_channel=0, is_current_step=False, sequencer=None, step_index=None, step_values=None):
         self.cc_number = cc_number
         self.led_index = led_index
         self.cc_value = cc_value
         self.midi_channel = midi_channel
+        add_controller(self)
         self.sequencer = sequencer
         self.step_index = step_index
+        # The sequencer array this controller writes its value into
+        self.step_values = step_values
         self.is_current_step = is_current_step
-        self.set_led_color(self.get_led_color())
+        self.set_led_color_byte(self.get_led_color_byte())
 
     def set_value(self, midi_channel, cc_number, cc_value):
         if midi_channel != self.midi_channel:
@@ -283,45 +394,51 @@ class Controller:
         old_cc_value = self.cc_value
         self.cc_value = cc_value
         if old_cc_value is None and cc_value is not None:
-            self.set_led_color(self.get_led_color())
-        if old_cc_value != cc_value:
+            self.set_led_color_byte(self.get_led_color_byte())
+        if old_cc_value != cc_value and self.step_values is not None:
+            self.step_values[self.step_index] = cc_value
             if self.is_current_step:
-                step_info = self.sequencer.get_step_info(self.step_index)
-                if self in self.sequencer.note_controllers:
-                    self.sequencer.output_note(step_info)
-                if self in self.sequencer.cv_controllers[self.step_index]:
-                    self.sequencer.output_cvs(step_info)
+                if self.step_values is self.sequencer.notes:
+                    self.sequencer.note_output.request(self.step_index)
+                else:
+                    self.sequencer.cv_output.request(self.step_index)
 
     def set_is_current_step(self, is_current_step):
         old_is_current_step = self.is_current_step
         self.is_current_step = is_current_step
         if old_is_current_step != is_current_step:
-            self.set_led_color(self.get_led_color())
+            self.set_led_color_byte(self.get_led_color_byte())
 
-    def get_led_color(self):
-        if self.cc_value is None:
-            return COLORS['RED_3'] if self.is_current_step else COLORS['RED_1']
-        else:
-            return COLORS['GREEN_3'] if self.is_current_step else COLORS['GREEN_1']
+    def get_led_color_byte(self):
+        return CONTROLLER_COLOR_BYTES[self.cc_value is not None][self.is_current_step]
 
-    def set_led_color(self, color=None):
+    def set_led_color_byte(self, color_byte=None):
         if self.led_index is None:
             return
 
-        if color is None:
+        if color_byte is None:
             return
 
-        set_led_color(self.led_index, color)
+        led_frame.set_led_color_byte(self.led_index, color_byte)
 
 controllers = []
+# Controllers listening to each (midi_channel, cc_number), so incoming CCs only reach their own controllers
+controllers_by_cc = collections.defaultdict(list)
+
+def add_controller(controller):
+    controllers.append(controller)
+    controllers_by_cc[(controller.midi_channel, controller.cc_number)].append(controller)
 
 class Sequencer:
-    def __init__(self, total_steps: int, clock, note_controller_row, button_row, cv_controller_rows=[], current_step=0):
+    def __init__(self, total_steps: int, clock, note_controller_row, button_row, cv_controller_rows=[], current_step=0, coalesce_window=0, pattern_bank: PatternBank | None=None):
         self.total_steps = total_steps
         self.clock = clock
         self.current_step = current_step
         self.is_gate_active = False
+        self.gate_active_step = None
+        self.gate_end_timer = None
         self.is_running = False
+        self.replay_step = False
         self.note_range = 8 # Volts
 
         self.step_controllers: list[list[Controller | Button]] = [[] for i in range(total_steps)]
@@ -329,6 +446,23 @@ class Sequencer:
         self.cv_controllers: list[list[Controller]] = [[] for i in range(total_steps)]
         self.buttons: list[Button] = []
 
+        # Step plan compiled from the step modes, every step starts out as a played STEP
+        self.next_steps: list[int] = [(i + 1) % total_steps for i in range(total_steps)]
+        self.played_steps: list[bool] = [True] * total_steps
+
+        # Step data read by the outputs, written by the step controllers and buttons
+        self.notes = array.array('B', bytes(total_steps))
+        self.cvs = [array.array('B', bytes(total_steps)) for i in range(3)]
+        self.duty_cycles = array.array('d', [GATE_LINE_MODES[0].duty_cycle] * total_steps)
+        # Note controller value scaled to the CV.OCD range
+        self.note_cv_ocd_values = bytes(remap_clamped_int(note, 0, 127, CV_OCD_MIDI_0V, get_cv_ocd_midi_value(self.note_range)) for note in range(128))
+
+        # Knob sweeps on the current step would flood the MIDI link, only their latest values are sent
+        if coalesce_window == 'pulse':
+            coalesce_window = lambda: self.clock.interval / 24
+        self.note_output = CoalescedOutput(clock, self.output_note, coalesce_window)
+        self.cv_output = CoalescedOutput(clock, self.output_cvs, coalesce_window)
+
         for i in range(total_steps):
             note_controller = note_controller_row[i]
             controller_obj = Controller(
@@ -337,6 +471,7 @@ class Sequencer:
                 cc_number=note_controller['cc_number'],
                 led_index=note_controller['led_index'],
                 is_current_step=i == current_step,
+                step_values=self.notes,
             )
             self.step_controllers[i].append(controller_obj)
             self.note_controllers.append(controller_obj)
@@ -355,7 +490,7 @@ class Sequencer:
             self.step_controllers[i].append(button_obj)
             self.buttons.append(button_obj)
 
-            for cv_controllers in cv_controller_rows:
+            for row, cv_controllers in enumerate(cv_controller_rows):
                 cv_controller = cv_controllers[i]
                 controller_obj = Controller(
                     sequencer=self,
@@ -363,10 +498,19 @@ class Sequencer:
                     cc_number=cv_controller['cc_number'],
                     led_index=cv_controller['led_index'],
                     is_current_step=i == current_step,
+                    step_values=self.cvs[row],
                 )
                 self.step_controllers[i].append(controller_obj)
                 self.cv_controllers[i].append(controller_obj)
 
+        # Each step value array with the controller writing into it for every step, None where there is none
+        self.value_rows = [(self.notes, self.note_controllers)] + [
+            (self.cvs[row], [controllers[row] if row < len(controllers) else None for controllers in self.cv_controllers])
+            for row in range(len(self.cvs))
+        ]
+
+        self.compile_step_plan()
+
         mode_buttons = RadioButtons(
             buttons=[
                 Button(
@@ -399,6 +543,8 @@ class Sequencer:
         self.clock.on_interval_percent(0.2, lambda: tempo_button.set_led_color(COLORS['OFF']))
 
         self.TAP_COUNT = 4
+        # Seconds after the last tap before tapping starts over
+        self.TAP_TIMEOUT = 3
         self.interval_shift_register = collections.deque([], self.TAP_COUNT)
 
         tempo_button.on_button_down.append(self.add_tempo_tap)
@@ -417,12 +563,27 @@ class Sequencer:
         reset_button.set_led_color(COLORS['RED_3'])
         reset_button.on_button_down.append(self.reset)
 
+        # LEFT queues the next pattern of the bank, which is switched to on the next step
+        self.pattern_bank = pattern_bank
+        self.pattern_index = 0
+        self.next_pattern_index = None
+        self.next_pattern = None
+        self.pattern_button = Button(
+            cc_number=LEFT['cc_number'],
+            led_index=LEFT['led_index'],
+        )
+        self.pattern_button.set_led_color(COLORS['OFF'])
+        self.pattern_button.on_button_down.append(self.queue_next_pattern)
+        if pattern_bank is not None:
+            self.pattern_index = pattern_bank.get_current_index()
+            self.set_pattern(pattern_bank.load(self.pattern_index))
+
         self.run()
 
     def add_tempo_tap(self, button):
-        now = time.time()
+        now = self.clock.get_time()
 
-        if len(self.interval_shift_register) > 0 and now - self.interval_shift_register[-1] > 3:
+        if len(self.interval_shift_register) > 0 and now - self.interval_shift_register[-1] > self.TAP_TIMEOUT:
             print('clearing tempo register')
             self.interval_shift_register.clear()
 
@@ -436,29 +597,175 @@ class Sequencer:
 
         print('bpm', bpm, 'interval', interval)
 
-        self.clock.bpm = bpm
-        self.clock.interval = interval
+        self.clock.set_bpm(bpm)
+
+    def get_pattern(self):
+        value_rows = [
+            bytes(UNSET_VALUE if controller is not None and controller.cc_value is None else value for value, controller in zip(step_values, controllers))
+            for step_values, controllers in self.value_rows
+        ]
+        return Pattern(
+            *value_rows,
+            step_modes=bytes(button.get_active_mode_index_for_modeset('step') for button in self.buttons),
+            gate_modes=bytes(button.get_active_mode_index_for_modeset('gate') for button in self.buttons),
+        )
+
+    def set_pattern(self, pattern: Pattern):
+        # Everything is set directly, then the step plan is compiled and the step LEDs are redrawn once
+        for (step_values, controllers), values in zip(self.value_rows, (pattern.notes, pattern.cv1, pattern.cv2, pattern.cv3)):
+            for step, (value, controller) in enumerate(zip(values, controllers)):
+                # Anything outside the MIDI range, like a damaged record, counts as never set
+                is_unset = value > 127
+                step_values[step] = 0 if is_unset else value
+                if controller is not None:
+                    controller.cc_value = None if is_unset else value
+
+        for button, step_mode, gate_mode in zip(self.buttons, pattern.step_modes, pattern.gate_modes):
+            button.active_modes['step'] = step_mode if step_mode < len(STEP_LINE_MODES) else 0
+            button.active_modes['gate'] = gate_mode if gate_mode < len(GATE_LINE_MODES) else 0
+            button.active_mode = button.get_active_mode_for_modeset(button.active_modeset_name)
+            self.duty_cycles[button.step_index] = button.get_active_mode_for_modeset('gate').duty_cycle
+
+        self.compile_step_plan()
+        for step_controllers in self.step_controllers:
+            for controller in step_controllers:
+                controller.set_led_color_byte(controller.get_led_color_byte())
+
+    def queue_next_pattern(self, button=None):
+        if self.pattern_bank is None:
+            return
+
+        queued_index = self.pattern_index if self.next_pattern_index is None else self.next_pattern_index
+        next_pattern_index = (queued_index + 1) % self.pattern_bank.pattern_count
+        if next_pattern_index == self.pattern_index:
+            # Back around to the current pattern, whose saved copy is older than what is playing
+            self.next_pattern_index = None
+            self.next_pattern = None
+            self.pattern_button.set_led_color(COLORS['OFF'])
+            return
+
+        self.next_pattern_index = next_pattern_index
+        # Read now, so switching on the step is only a matter of setting values
+        self.next_pattern = self.pattern_bank.load(self.next_pattern_index)
+        self.pattern_button.set_led_color(COLORS['AMBER_3'])
+
+    def switch_pattern(self):
+        self.pattern_bank.save(self.pattern_index, self.get_pattern())
+        self.pattern_index = self.next_pattern_index
+        self.pattern_bank.set_current_index(self.pattern_index)
+        self.set_pattern(self.next_pattern)
+        self.next_pattern_index = None
+        self.next_pattern = None
+        self.pattern_button.set_led_color(COLORS['OFF'])
+
+    def get_snapshot(self):
+        now = self.clock.get_time()
+        taps = self.interval_shift_register
+        return {
+            'pattern_index': self.pattern_index,
+            'pattern': {field: list(values) for field, values in self.get_pattern()._asdict().items()},
+            'bpm': self.clock.bpm,
+            # Taps as seconds before the snapshot, the time source's epoch doesn't survive a restart. Taps that
+            # timed out would be cleared by the next one anyway.
+            'taps': [tap - now for tap in taps] if taps and now - taps[-1] <= self.TAP_TIMEOUT else [],
+        }
+
+    def restore_snapshot(self, snapshot):
+        # Everything is checked before anything is changed, a bad snapshot leaves the sequencer as it was
+        pattern_index = snapshot['pattern_index']
+        if not isinstance(pattern_index, int):
+            raise ValueError(f'Pattern index {pattern_index!r} is not a number')
+        if set(snapshot['pattern']) != set(Pattern._fields):
+            raise ValueError(f'Snapshot pattern has {sorted(snapshot["pattern"])}, expected {list(Pattern._fields)}')
+        value_limits = {'step_modes': len(STEP_LINE_MODES), 'gate_modes': len(GATE_LINE_MODES)}
+        for field, values in snapshot['pattern'].items():
+            if len(values) != self.total_steps:
+                raise ValueError(f'Snapshot {field} has {len(values)} steps, expected {self.total_steps}')
+            limit = value_limits.get(field, 128)
+            if not all(isinstance(value, int) and (0 <= value < limit or (limit == 128 and value == UNSET_VALUE)) for value in values):
+                raise ValueError(f'Snapshot {field} has values out of range: {values}')
+        bpm = snapshot['bpm']
+        # Also false for NaN
+        if not isinstance(bpm, (int, float)) or not 0 < bpm < float('inf'):
+            raise ValueError(f'Snapshot tempo {bpm!r} is not a positive number')
+        taps = snapshot['taps']
+        if not all(isinstance(tap, (int, float)) and -self.TAP_TIMEOUT * self.TAP_COUNT <= tap <= 0 for tap in taps):
+            raise ValueError(f'Snapshot taps {taps!r} are not recent times')
+
+        if self.pattern_bank is not None and 0 <= pattern_index < self.pattern_bank.pattern_count:
+            self.pattern_index = pattern_index
+            self.pattern_bank.set_current_index(self.pattern_index)
+        self.set_pattern(Pattern(**{field: bytes(values) for field, values in snapshot['pattern'].items()}))
+        self.clock.set_bpm(bpm)
+        now = self.clock.get_time()
+        self.interval_shift_register.clear()
+        self.interval_shift_register.extend(now + tap for tap in taps)
 
     def run(self, button=None):
         self.is_running = not self.is_running
         self.run_button.set_led_color(COLORS['RED_3'] if self.is_running else COLORS['OFF'])
-        self.clock.run()
+        with self.clock.transport_change() as transport_time:
+            step_started_at = self.clock.time
+            self.clock.run()
+            if not self.is_running:
+                # Timers don't run while stopped, so the gate would stay open until the sequencer runs again
+                if self.gate_end_timer is not None:
+                    self.gate_end_timer.cancel()
+                self.end_gate()
+                # Knob output held back until a timer that won't run now goes out right away
+                self.note_output.flush()
+                self.cv_output.flush()
+                # A step that started right as the sequencer stopped never got to sound, it is played again
+                # when the sequencer continues
+                self.replay_step = step_started_at >= transport_time
+            elif self.replay_step:
+                self.replay_step = False
+                self.output_note(self.current_step)
+                self.output_cvs(self.current_step)
+                self.output_gate(self.current_step)
 
     def reset(self, button):
-        self.is_gate_active = False
-        self.clock.reset()
-        self.step(0)
-        self.output_gate_off()
+        with self.clock.transport_change():
+            self.is_gate_active = False
+            self.clock.reset()
+            self.step(0)
+            self.output_gate_off()
 
     def get_first_reset_index(self):
         first_reset_index = None
         for i, seq_button in enumerate(self.buttons):
-            if seq_button.get_active_mode_for_modeset('step')['name'] == 'RESET':
+            if seq_button.get_active_mode_for_modeset('step').name == 'RESET':
                 first_reset_index = i
                 break
         return first_reset_index
 
-    def get_next_step(self, current_step: int, initial_step: int | None=None):
+    def on_mode_change(self, button: Button, modeset_name: str):
+        if modeset_name == 'step':
+            self.compile_step_plan()
+        elif modeset_name == 'gate':
+            self.duty_cycles[button.step_index] = button.get_active_mode_for_modeset('gate').duty_cycle
+
+    def compile_step_plan(self):
+        # Buttons compile the plan as their step modes are set, wait until all of them exist
+        if len(self.buttons) < self.total_steps:
+            return
+
+        first_reset_index = self.get_first_reset_index()
+        old_played_steps = self.played_steps
+        self.next_steps = [self.find_next_step(step) for step in range(self.total_steps)]
+        self.played_steps = [
+            (first_reset_index is None or step <= first_reset_index) and button.get_active_mode_for_modeset('step').played
+            for step, button in enumerate(self.buttons)
+        ]
+
+        for button, was_played, is_played in zip(self.buttons, old_played_steps, self.played_steps):
+            if was_played != is_played:
+                button.set_led_color_byte(button.get_led_color_byte())
+
+    def get_next_step(self, current_step: int):
+        return self.next_steps[current_step]
+
+    def find_next_step(self, current_step: int, initial_step: int | None=None):
         if initial_step == current_step:
             return current_step
 
@@ -471,73 +778,52 @@ class Sequencer:
         next_step_button = self.buttons[next_step]
         next_step_mode = next_step_button.get_active_mode_for_modeset('step')
 
-        if current_step_mode['name'] == 'STOP':
+        if current_step_mode.name == 'STOP':
             return current_step
 
-        if next_step_mode['name'] == 'RESET':
+        if next_step_mode.name == 'RESET':
             for step, step_line_button in enumerate(self.buttons):
-                if step_line_button.get_active_mode_for_modeset('step')['played']:
+                if step_line_button.get_active_mode_for_modeset('step').played:
                     return step
             return current_step
-        elif next_step_mode['name'] == 'SKIP':
-            return self.get_next_step(next_step, initial_step)
-        elif next_step_mode['name'] == 'STOP':
+        elif next_step_mode.name == 'SKIP':
+            return self.find_next_step(next_step, initial_step)
+        elif next_step_mode.name == 'STOP':
             return next_step
-        elif next_step_mode['name'] == 'STEP':
+        elif next_step_mode.name == 'STEP':
             return next_step
         else:
             return current_step
 
-    def get_step_info(self, step: int):
-        note = 0
-        note_controller = self.note_controllers[step]
-        if note_controller.cc_value is not None:
-            note = note_controller.cc_value
-
-        # Scale to CV.OCD range
-        note = remap_clamped_int(note, 0, 127, CV_OCD_MIDI_0V, get_cv_ocd_midi_value(self.note_range))
-
-        cvs = [0, 0, 0]
-        for i, cv_controller in enumerate(self.cv_controllers[step]):
-            value = cv_controller.cc_value
-            if value is not None:
-                cvs[i] = value
-
-        button = self.buttons[step]
-        return {
-            'note': note,
-            'cv1': cvs[0],
-            'cv2': cvs[1],
-            'cv3': cvs[2],
-            'duty_cycle': button.get_active_mode_for_modeset('gate')['duty_cycle'],
-        }
-
     def output_pulse(self, on_callback, off_callback, start_time=0, end_time=0):
+        # Timed from when the output is due rather than from the start of the beat, which may have passed,
+        # or the off could be stamped before the on
+        at = self.clock.get_event_context()[0]
         if start_time == 0:
             on_callback()
         else:
-            self.clock.once_time(start_time, lambda: on_callback())
-        self.clock.once_time(end_time, lambda: off_callback())
+            self.clock.once_at(at + start_time, on_callback)
+        self.clock.once_at(at + end_time, off_callback)
 
-    def output_trigger(self, step_info):
+    def output_trigger(self):
         def trigger_on():
             debug_print('trigger on')
-            send_midi_message(mido.Message('control_change', channel=0, control=TRIGGER_CC, value=127))
+            send_midi_bytes(TRIGGER_ON)
 
         def trigger_off():
             debug_print('trigger off')
-            send_midi_message(mido.Message('control_change', channel=0, control=TRIGGER_CC, value=0))
+            send_midi_bytes(TRIGGER_OFF)
 
         self.output_pulse(trigger_on, trigger_off)
 
-    def output_gate_on(self, step_info):
+    def output_gate_on(self):
         if self.is_gate_active:
             return
-        self.output_trigger(step_info)
+        self.output_trigger()
         self.is_gate_active = True
 
         debug_print('gate on')
-        send_midi_message(mido.Message('control_change', channel=0, control=GATE_CC, value=127))
+        send_midi_bytes(GATE_ON)
 
     def output_gate_off(self):
         if not self.is_gate_active:
@@ -545,59 +831,78 @@ class Sequencer:
         self.is_gate_active = False
 
         debug_print('gate off')
-        send_midi_message(mido.Message('control_change', channel=0, control=GATE_CC, value=0))
+        send_midi_bytes(GATE_OFF)
+
+    def set_gate_active_step(self, step_index: int | None):
+        if self.gate_active_step is not None and self.gate_active_step != step_index:
+            self.buttons[self.gate_active_step].set_is_gate_active(False)
+        self.gate_active_step = step_index
+        if step_index is not None:
+            self.buttons[step_index].set_is_gate_active(True)
+
+    def end_gate(self):
+        self.gate_end_timer = None
+        self.output_gate_off()
+        self.set_gate_active_step(None)
+
+    def output_gate(self, step_index: int):
+        # The new step owns the gate, a gate end left over from the previous one must not cut it short
+        if self.gate_end_timer is not None:
+            self.gate_end_timer.cancel()
+            self.gate_end_timer = None
 
-    def output_gate(self, step_info, step_index):
-        if step_info['duty_cycle'] == 0:
+        duty_cycle = self.duty_cycles[step_index]
+        if duty_cycle == 0:
             self.output_gate_off()
-            for i, button in enumerate(self.buttons):
-                button.set_is_gate_active(i == step_index)
+            self.set_gate_active_step(step_index)
             return
 
-        if step_info['duty_cycle'] < 1:
-            self.output_pulse(lambda: self.output_gate_on(step_info), self.output_gate_off, end_time=step_info['duty_cycle'] * self.clock.interval)
-        else:
-            self.output_gate_on(step_info)
-
-        for i, button in enumerate(self.buttons):
-            button.set_is_gate_active(i == step_index)
-            if step_info['duty_cycle'] < 1:
-                self.clock.once_time(step_info['duty_cycle'] * self.clock.interval, lambda button=button: button.set_is_gate_active(False))
+        self.output_gate_on()
+        self.set_gate_active_step(step_index)
+        if duty_cycle < 1:
+            self.gate_end_timer = self.clock.once_time(duty_cycle * self.clock.interval, self.end_gate)
 
-    def output_note(self, step_info):
-        if self.buttons[self.current_step].get_active_mode_for_modeset('gate')['name'] == 'SILENT':
+    def output_note(self, step: int):
+        # Silent steps have a duty cycle of 0
+        if self.duty_cycles[step] == 0:
             return
 
+        note = self.note_cv_ocd_values[self.notes[step]]
+
         def note_on():
-            debug_print('note', step_info['note'])
-            send_midi_message(mido.Message('note_on', channel=0, note=step_info['note'], velocity=127))
+            debug_print('note', note)
+            send_midi_bytes(NOTE_ON_BYTES[note])
 
         def note_off():
-            send_midi_message(mido.Message('note_off', channel=0, note=step_info['note'], velocity=127))
+            send_midi_bytes(NOTE_OFF_BYTES[note])
 
         self.output_pulse(note_on, note_off)
 
-    def output_cvs(self, step_info):
-        if self.buttons[self.current_step].get_active_mode_for_modeset('gate')['name'] == 'SILENT':
+    def output_cvs(self, step: int):
+        if self.duty_cycles[step] == 0:
             return
 
-        debug_print(f'cv1: {step_info["cv1"]}, cv2: {step_info["cv2"]}, cv3: {step_info["cv3"]}')
-        send_midi_message(mido.Message('control_change', channel=0, control=CV1_CC, value=step_info['cv1']))
-        send_midi_message(mido.Message('control_change', channel=0, control=CV2_CC, value=step_info['cv2']))
-        send_midi_message(mido.Message('control_change', channel=0, control=CV3_CC, value=step_info['cv3']))
+        cv1, cv2, cv3 = self.cvs[0][step], self.cvs[1][step], self.cvs[2][step]
+        debug_print(f'cv1: {cv1}, cv2: {cv2}, cv3: {cv3}')
+        send_midi_bytes(CV1_BYTES[cv1])
+        send_midi_bytes(CV2_BYTES[cv2])
+        send_midi_bytes(CV3_BYTES[cv3])
 
     def output_end_of_sequence(self):
         def end_of_sequence_on():
             debug_print('end of sequence on')
-            send_midi_message(mido.Message('control_change', channel=0, control=END_OF_SEQUENCE_CC, value=127))
+            send_midi_bytes(END_OF_SEQUENCE_ON)
 
         def end_of_sequence_off():
             debug_print('end of sequence off')
-            send_midi_message(mido.Message('control_change', channel=0, control=END_OF_SEQUENCE_CC, value=0))
+            send_midi_bytes(END_OF_SEQUENCE_OFF)
 
         self.output_pulse(end_of_sequence_on, end_of_sequence_off)
 
     def step(self, step_index=None):
+        if self.next_pattern is not None:
+            self.switch_pattern()
+
         if step_index is None:
             step_index = self.get_next_step(self.current_step)
         old_step = self.current_step
@@ -605,155 +910,389 @@ class Sequencer:
 
         if step_index <= old_step:
             self.output_end_of_sequence()
-        step_info = self.get_step_info(step_index)
-        self.output_note(step_info)
-        self.output_cvs(step_info)
-        self.output_gate(step_info, step_index)
-
-        for i, step_controllers in enumerate(self.step_controllers):
-            for controller in step_controllers:
-                controller.set_is_current_step(i == step_index)
+        # Step boundaries are sent right away and replace any knob output still waiting
+        self.note_output.cancel()
+        self.cv_output.cancel()
+        self.output_note(step_index)
+        self.output_cvs(step_index)
+        self.output_gate(step_index)
+
+        # Only the outgoing and incoming steps change
+        if step_index != old_step:
+            for controller in self.step_controllers[old_step]:
+                controller.set_is_current_step(False)
+        for controller in self.step_controllers[step_index]:
+            controller.set_is_current_step(True)
+
+input_to_midi_latency = get_histogram('input_to_midi_latency')
+input_to_led_latency = get_histogram('input_to_led_latency')
+
+# Incoming messages wait here for the clock loop, the only thread that touches controller and sequencer state
+input_queue = queue.SimpleQueue()
+
+def queue_midi_message(message: mido.Message):
+    # Called on rtmidi's callback thread. Stamped with the clock's time source once there is a clock, so
+    # simulated input shares its time base.
+    received_at = clock.get_time() if clock is not None else monotonic_time()
+    input_queue.put((received_at, message))
+    if clock is not None:
+        clock.wakeup.set()
+
+def process_input():
+    while True:
+        try:
+            received_at, message = input_queue.get_nowait()
+        except queue.Empty:
+            return
+        receive_midi_message(message, received_at)
 
-def receive_midi_message(message: mido.Message):
+def receive_midi_message(message: mido.Message, received_at: float):
     debug_print('IN:', message)
 
     if not message.is_cc():
         return
 
-    for controller in controllers:
-        controller.set_value(message.channel, message.control, message.value)
+    # MIDI output caused by this message is timestamped with its arrival, so the writer can tell how long it took
+    clock.set_event_context(received_at, input_to_midi_latency)
+    try:
+        for controller in controllers_by_cc.get((message.channel, message.control), ()):
+            controller.set_value(message.channel, message.control, message.value)
+    finally:
+        clock.set_event_context(None)
+
+    if flush_output():
+        input_to_led_latency.record((clock.get_time() - received_at) * 1_000_000)
+
+def dump_metrics(signum=None, frame=None):
+    for histogram in histograms.values():
+        print(histogram)
+    if midi_out is not None:
+        print('midi_out:', midi_out.get_stats())
+    if sequencer is not None:
+        print('coalesced: dropped', sequencer.note_output.dropped_count, 'notes,', sequencer.cv_output.dropped_count, 'cvs')
+    if port_manager is not None:
+        print('usb_midi_out: dropped', port_manager.dropped_count)
+
+# Set by the port manager's thread when the device (re)connects, the clock loop then resends the LEDs
+led_refresh_requested = threading.Event()
+
+def on_ports_connected():
+    led_refresh_requested.set()
+    if clock is not None:
+        clock.wakeup.set()
+
+def process_led_refresh():
+    # The device may have lost its LED state while disconnected, the next flush resends all of it
+    if led_refresh_requested.is_set():
+        led_refresh_requested.clear()
+        led_frame.refresh()
 
 partial_input_name = 'Launch Control XL'
 partial_output_name = 'Launch Control XL'
-inport = None
-outport = None
-
-def get_ports():
-    global inport, outport
-
-    if inport and outport:
-        return inport, outport
+midi_out_device = os.environ.get('MIDI_OUT_DEVICE', '/dev/serial0')
+
+def start_outputs():
+    global port_manager, midi_out
+
+    # The Launch Control XL ports are opened in the background whenever the device shows up, nothing waits for them
+    port_manager = PortManager(partial_input_name, partial_output_name, callback=queue_midi_message)
+    port_manager.on_connect.append(on_ports_connected)
+    port_manager.start()
+
+    if os.path.exists(midi_out_device):
+        # Messages are timestamped and written to the serial port by a separate thread when they are due, messages
+        # due at the same time together. It keeps within the link's byte budget by sending timing-critical messages
+        # first and merging stale CVs.
+        midi_out = SerialMidiWriter(serial.Serial(midi_out_device, baudrate=31250), mergeable_controls=[CV1_CC, CV2_CC, CV3_CC], spin_time=SPIN_TIME, get_time=monotonic_time)
+        if REALTIME:
+            # The writer decides when output actually happens, so it gets to preempt the clock
+            midi_out.on_start.append(lambda: enable_realtime('MIDI output', REALTIME_PRIORITY, REALTIME_CPU))
+        midi_out.start()
+
+class Timer:
+    def __init__(self, clock, callback, percent=None):
+        self.clock = clock
+        self.callback = callback
+        self.percent = percent
 
-    inport = None
-    outport = None
+    def is_pending(self):
+        return self.callback is not None
 
-    try:
-        input_port_names = mido.get_input_names()
-        output_port_names = mido.get_output_names()
-    except Exception as e:
-        print('Failed to get ports')
-        return None, None
-
-    input_port_name = next((name for name in input_port_names if partial_input_name in name), None)
-    output_port_name = next((name for name in output_port_names if partial_output_name in name), None)
-    if input_port_name is None or output_port_name is None:
-        return None, None
-
-    inport = mido.open_input(input_port_name, callback=receive_midi_message)
-    print('Opened MIDI input', inport.name)
-    outport = mido.open_output(output_port_name)
-    print('Opened MIDI output', outport.name)
-
-    return inport, outport
-
-def reset_ports():
-    global inport, outport
-    if inport:
-        print('Closing MIDI input', inport.name)
-        inport.close()
-        inport = None
-    if outport:
-        print('Closing MIDI output', outport.name)
-        outport.close()
-        outport = None
-
-inport, outport = get_ports()
-
-midi_out_device = '/dev/serial0'
-midi_out = os.path.exists(midi_out_device) and serial.Serial(midi_out_device, baudrate=31250) or None
+    def cancel(self):
+        if self.callback is None:
+            return
+        self.callback = None
+        self.clock.on_timer_cancelled()
 
 class Clock:
-    def __init__(self, bpm):
+    def __init__(self, bpm, spin_time=SPIN_TIME, lookahead=LOOKAHEAD, get_time=monotonic_time):
+        # Where the clock gets the current time from, a virtual timebase renders faster than real time
+        self.get_time = get_time
         self.is_running = False
         self.bpm = bpm
         self.interval = 60 / bpm
-        self.time = time.time()
+        self.time = self.get_time()
         self.next_run_start = True
+        self.spin_time = spin_time
+        # Events run this long before they are due, their output is timestamped with the time they are due at
+        self.lookahead = lookahead
+        self.max_pass_time = 0.005
+        # The latest time output has been handed out for, anything up to it can't be taken back
+        self.horizon = self.time
+        self.local = threading.local()
+        # How late events run compared to when they were scheduled to run, lookahead included
+        self.lateness = get_histogram('clock_lateness')
         self.on_tick_callbacks = []
-        self.once_time_callbacks = []
         self.on_interval_percent_callbacks = []
-        self.on_interval_percent_callbacks_to_call = []
 
-        self.on_tick(self.reset_on_interval_percent_callbacks)
+        # Heap of (deadline, order, sequence, timer) entries with absolute
+        # deadlines. Cancelled timers stay in the heap until they reach the top
+        # or until they make up half of it, then the heap is compacted.
+        self.deadlines = []
+        self.cancelled_count = 0
+        self.interval_timers = []
+        self.sequence = itertools.count()
+        # Only the clock loop's thread touches the clock, other threads may only set this to wake it up
+        self.wakeup = threading.Event()
 
         for i in range(1, 25):
-            self.on_interval_percent(i / 24, lambda: send_midi_message(mido.Message('clock')))
+            self.on_interval_percent(i / 24, lambda: send_midi_bytes(MIDI_CLOCK))
+
+        self.schedule_interval()
+
+    @contextlib.contextmanager
+    def transport_change(self):
+        # Events up to the horizon already ran and their output is with the writer, so a transport change
+        # takes effect at the horizon rather than before it. Output sent inside is stamped with that time,
+        # so it follows whatever was sent for the events that already ran.
+        previous_context = getattr(self.local, 'event_time', None), getattr(self.local, 'event_histogram', None)
+        event_time, histogram = self.get_event_context()
+        self.set_event_context(max(event_time, self.horizon), histogram)
+        try:
+            yield self.local.event_time
+        finally:
+            self.set_event_context(*previous_context)
 
     def run(self):
-        if self.is_running:
-            send_midi_message(mido.Message('stop'))
-        elif self.next_run_start:
-            send_midi_message(mido.Message('start'))
-            self.next_run_start = False
-        else:
-            send_midi_message(mido.Message('continue'))
+        with self.transport_change() as transport_time:
+            if self.is_running:
+                send_midi_bytes(MIDI_STOP)
+            elif self.next_run_start:
+                send_midi_bytes(MIDI_START)
+                self.next_run_start = False
+            else:
+                send_midi_bytes(MIDI_CONTINUE)
 
-        self.is_running = not self.is_running
-        self.time = time.time()
+            self.is_running = not self.is_running
+            self.rebase(transport_time)
 
     def reset(self):
-        if self.is_running:
-            send_midi_message(mido.Message('start'))
-        else:
-            self.next_run_start = True
-        self.time = time.time()
-
-    def set_time(self):
-        if not self.is_running:
-            return
+        with self.transport_change() as transport_time:
+            if self.is_running:
+                send_midi_bytes(MIDI_START)
+            else:
+                self.next_run_start = True
+            self.rebase(transport_time)
+            self.schedule_interval()
 
-        old_time = self.time
-        new_time = time.time()
-        diff = new_time - old_time
+    def set_bpm(self, bpm):
+        self.bpm = bpm
+        self.interval = 60 / bpm
 
-        for at_time, callback in self.once_time_callbacks:
-            if diff >= at_time:
-                callback()
-                self.once_time_callbacks.remove((at_time, callback))
+        # Move whatever is left of the current interval to the new tempo
+        pending = [timer for timer in self.interval_timers if timer.is_pending()]
+        self.interval_timers = []
+        for timer in pending:
+            callback, percent = timer.callback, timer.percent
+            timer.cancel()
+            self.interval_timers.append(self.push(self.time + percent * self.interval, callback, percent, order=int(callback == self.tick)))
+
+    def rebase(self, new_time):
+        # Shifting every deadline by the same amount keeps the heap valid
+        shift = new_time - self.time
+        self.deadlines = [(deadline + shift, order, sequence, timer) for deadline, order, sequence, timer in self.deadlines]
+        self.time = new_time
+
+    def push(self, deadline, callback, percent=None, order=0):
+        timer = Timer(self, callback, percent)
+        heapq.heappush(self.deadlines, (deadline, order, next(self.sequence), timer))
+        return timer
+
+    def on_timer_cancelled(self):
+        self.cancelled_count += 1
+        if self.cancelled_count > 64 and self.cancelled_count * 2 > len(self.deadlines):
+            self.deadlines = [entry for entry in self.deadlines if entry[3].is_pending()]
+            heapq.heapify(self.deadlines)
+            self.cancelled_count = 0
+
+    def schedule_interval(self):
+        for timer in self.interval_timers:
+            timer.cancel()
+        self.interval_timers = [self.push(self.time + percent * self.interval, callback, percent) for percent, callback in self.on_interval_percent_callbacks]
+        # Ticks sort after interval percent callbacks due at the same time
+        self.interval_timers.append(self.push(self.time + self.interval, self.tick, 1, order=1))
+
+    def tick(self):
+        self.time += self.interval
+        self.schedule_interval()
+        for callback in self.on_tick_callbacks:
+            callback()
+
+    def pop_cancelled(self):
+        while self.deadlines and not self.deadlines[0][3].is_pending():
+            heapq.heappop(self.deadlines)
+            self.cancelled_count = max(self.cancelled_count - 1, 0)
+
+    def get_next_deadline(self):
+        self.pop_cancelled()
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def wait(self):
+        # Returns at the next deadline, or as soon as input arrives. The wakeup is cleared only after waiting,
+        # so input queued while the loop was busy isn't missed.
+        deadline = self.get_next_deadline() if self.is_running else None
+        if deadline is None:
+            self.wakeup.wait()
+        else:
+            deadline -= self.lookahead
+            sleep_time = deadline - self.get_time() - self.spin_time
+            if sleep_time <= 0 or not self.wakeup.wait(sleep_time):
+                # Sleeping is too coarse for the last stretch, so spin until the deadline. sleep(0) lets other
+                # threads, like the output writer, take the GIL meanwhile.
+                while self.get_time() < deadline and not self.wakeup.is_set():
+                    time.sleep(0)
+        self.wakeup.clear()
+
+    def set_event_context(self, event_time, histogram=None):
+        self.local.event_time = event_time
+        self.local.event_histogram = histogram
+
+    def get_event_context(self):
+        # When output sent from the current thread is due, the event's deadline inside a clock callback and
+        # otherwise now, and the histogram that should record how late it was actually sent
+        event_time = getattr(self.local, 'event_time', None)
+        if event_time is None:
+            return self.get_time(), None
+        return event_time, self.local.event_histogram
 
-        for callback_tuple in self.on_interval_percent_callbacks:
-            percent, callback = callback_tuple
-            if diff >= self.interval * percent and callback_tuple in self.on_interval_percent_callbacks_to_call:
+    def set_time(self):
+        now = self.get_time()
+        pass_end = now + self.max_pass_time
+        while self.is_running:
+            self.pop_cancelled()
+            if not self.deadlines:
+                return
+            if self.deadlines[0][0] > now + self.lookahead:
+                # Callbacks may have taken a while, catch anything that became due meanwhile
+                now = self.get_time()
+                if self.deadlines[0][0] > now + self.lookahead:
+                    return
+            deadline, _, _, timer = heapq.heappop(self.deadlines)
+
+            callback = timer.callback
+            timer.callback = None
+            if callback is not None:
+                fired_at = self.get_time()
+                self.lateness.record((fired_at - deadline + self.lookahead) * 1_000_000)
+                # Late events go out right away, never before output that was sent earlier
+                event_time = max(deadline, now)
+                self.horizon = max(self.horizon, event_time)
+                self.set_event_context(event_time)
                 callback()
-                self.on_interval_percent_callbacks_to_call.remove(callback_tuple)
+                self.set_event_context(None)
 
-        if diff >= self.interval:
-            self.time = old_time + self.interval
-            for callback in self.on_tick_callbacks:
-                callback()
+                # A clock that can't keep up would never leave this loop, return now and then to let output be flushed
+                if fired_at > pass_end:
+                    return
 
     def on_tick(self, callback):
         self.on_tick_callbacks.append(callback)
 
     def once_time(self, at_time, callback):
-        self.once_time_callbacks.append((at_time, callback))
+        return self.push(self.time + at_time, callback)
+
+    def once_at(self, deadline, callback):
+        return self.push(deadline, callback)
 
     def on_interval_percent(self, percent, callback):
         self.on_interval_percent_callbacks.append((percent, callback))
-        self.reset_on_interval_percent_callbacks()
-
-    def reset_on_interval_percent_callbacks(self):
-        self.on_interval_percent_callbacks_to_call = [callback for callback in self.on_interval_percent_callbacks if callback[0] * self.interval > time.time() - self.time]
-
-clock = Clock(bpm=BPM)
-sequencer = Sequencer(
-    total_steps=16,
-    clock=clock,
-    note_controller_row=SEND_A + PAN_DEVICE,
-    button_row=TRACK_FOCUS + TRACK_CONTROL,
-    cv_controller_rows=[SEND_B + FADERS],
-)
-
-while True:
-    clock.set_time()
-    time.sleep(0.001)
+        if percent * self.interval > self.get_time() - self.time:
+            self.interval_timers.append(self.push(self.time + percent * self.interval, callback, percent))
+
+def create_sequencer(bpm=BPM, lookahead=LOOKAHEAD, get_time=monotonic_time, coalesce_window=OUTPUT_COALESCE_WINDOW, pattern_bank=None):
+    global clock, sequencer
+
+    controllers.clear()
+    controllers_by_cc.clear()
+
+    clock = Clock(bpm=bpm, lookahead=lookahead, get_time=get_time)
+    sequencer = Sequencer(
+        total_steps=TOTAL_STEPS,
+        clock=clock,
+        note_controller_row=SEND_A + PAN_DEVICE,
+        button_row=TRACK_FOCUS + TRACK_CONTROL,
+        cv_controller_rows=[SEND_B + FADERS],
+        coalesce_window=coalesce_window,
+        pattern_bank=pattern_bank,
+    )
+    return sequencer
+
+def run_clock_loop(until=None):
+    # Input and clock events are handled one after the other on this thread, never at the same time
+    while until is None or clock.get_time() < until:
+        clock.wait()
+        process_led_refresh()
+        process_input()
+        clock.set_time()
+        flush_output()
+        if snapshot_writer is not None:
+            snapshot_writer.poll()
+
+def run_simulated_clock(manual_time: ManualTime, until):
+    # Nothing happens between deadlines, so virtual time jumps straight to the next one
+    while True:
+        deadline = clock.get_next_deadline()
+        if deadline is None or deadline >= until:
+            break
+        manual_time.set(deadline)
+        clock.set_time()
+    manual_time.set(until)
+
+def report_first_clock_pulse():
+    first_pulse_at = clock.get_event_context()[0]
+    print(f'First clock pulse {(first_pulse_at - STARTED_AT) * 1000:.1f} ms after start')
+
+def start_snapshots():
+    global snapshot_writer
+
+    # Knob values, modes and tempo come back as they were before the first tick
+    snapshot = load_snapshot(STATE_PATH)
+    if snapshot is not None:
+        try:
+            sequencer.restore_snapshot(snapshot)
+            print('Restored state from', STATE_PATH)
+        except (KeyError, TypeError, ValueError) as e:
+            print('Failed to restore state', e)
+
+    snapshot_writer = SnapshotWriter(STATE_PATH, sequencer.get_snapshot, clock.wakeup.set, SNAPSHOT_INTERVAL)
+    snapshot_writer.start()
+
+def main():
+    start_outputs()
+    create_sequencer(pattern_bank=open_pattern_bank(PATTERN_BANK_PATH, PATTERN_COUNT, TOTAL_STEPS))
+    # Started before the clock thread turns real-time, so the writer doesn't inherit its priority
+    start_snapshots()
+    # The whole initial LED state goes out as one frame, or is replayed as one once the device connects
+    flush_output()
+    clock.once_time(clock.interval / 24, report_first_clock_pulse)
+
+    signal.signal(signal.SIGUSR1, dump_metrics)
+
+    if REALTIME:
+        lock_memory()
+        enable_realtime('clock', REALTIME_PRIORITY - 1, REALTIME_CPU)
+
+    run_clock_loop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import mido
+import serial
+from timesource import ManualTime, monotonic_time
+
+# Runs the sequencer against in-memory stand-ins for the Launch Control XL ports and the serial port, and
+# appends the results as a JSON line to bench_output.txt, e.g. `python bench.py`
+
+BENCH_OUTPUT = 'bench_output.txt'
+DURATION = float(os.environ.get('BENCH_DURATION', 2))
+JITTER_BPMS = [120, 240, 480]
+MAX_BPM = 6_000_000
+CC_DISPATCH_COUNT = 20000
+
+class StubInputPort:
+    def __init__(self, name, callback=None):
+        self.name = name
+        self.callback = callback
+
+    def close(self):
+        pass
+
+class StubOutputPort:
+    def __init__(self, name):
+        self.name = name
+        self.sent_count = 0
+
+    def send(self, message):
+        self.sent_count += 1
+
+    def close(self):
+        pass
+
+class StubSerial:
+    def __init__(self, port, baudrate=9600):
+        self.port = port
+        self.baudrate = baudrate
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append((monotonic_time(), bytes(data)))
+        return len(data)
+
+STUB_PORT_NAME = 'Launch Control XL:Launch Control XL MIDI 1 20:0'
+stub_ports = {}
+
+def open_stub_input(name, callback=None):
+    stub_ports['input'] = StubInputPort(name, callback)
+    return stub_ports['input']
+
+def open_stub_output(name):
+    stub_ports['output'] = StubOutputPort(name)
+    return stub_ports['output']
+
+mido.get_input_names = lambda: [STUB_PORT_NAME]
+mido.get_output_names = lambda: [STUB_PORT_NAME]
+mido.open_input = open_stub_input
+mido.open_output = open_stub_output
+serial.Serial = StubSerial
+
+# app opens the MIDI output device only if it exists
+stub_serial_device = tempfile.NamedTemporaryFile(prefix='bench-serial-')
+os.environ['MIDI_OUT_DEVICE'] = stub_serial_device.name
+
+import app
+
+app.start_outputs()
+app.create_sequencer()
+app.flush_output()
+
+def wait_for_ports(timeout=5):
+    end = time.time() + timeout
+    while app.port_manager.ports is None:
+        if time.time() > end:
+            raise RuntimeError('Stub ports were not opened')
+        time.sleep(0.01)
+
+steps = [0]
+app.clock.on_tick(lambda: steps.__setitem__(0, steps[0] + 1))
+
+def restart_clock(bpm, warmup=0.2):
+    app.clock.set_bpm(bpm)
+    app.clock.reset()
+    # Let whatever the previous benchmark left queued drain before measuring
+    app.run_clock_loop(until=app.clock.get_time() + warmup)
+    time.sleep(app.LOOKAHEAD)
+    for histogram in app.histograms.values():
+        histogram.reset()
+
+def summarize(histogram):
+    return {
+        'count': histogram.count,
+        'p50_us': histogram.get_percentile(50),
+        'p99_us': histogram.get_percentile(99),
+        'max_us': histogram.max,
+    }
+
+def bench_throughput():
+    # At this tempo deadlines are always due, so the loop runs as fast as it can
+    restart_clock(MAX_BPM)
+    start_steps = steps[0]
+    start = time.perf_counter()
+    app.run_clock_loop(until=app.clock.get_time() + DURATION)
+    elapsed = time.perf_counter() - start
+    return {
+        'steps_per_second': (steps[0] - start_steps) / elapsed,
+        'clock_events_per_second': app.clock.lateness.count / elapsed,
+    }
+
+def bench_cc_dispatch():
+    # A sweep on a fader and on the knob of the current step, which also sends MIDI
+    current_step_knob = app.sequencer.note_controllers[app.sequencer.current_step].cc_number
+    fader = app.sequencer.cv_controllers[8][0].cc_number
+    messages = [
+        mido.Message('control_change', channel=0, control=current_step_knob if i % 2 else fader, value=i % 128)
+        for i in range(CC_DISPATCH_COUNT)
+    ]
+    callback = stub_ports['input'].callback
+    start = time.perf_counter()
+    for message in messages:
+        callback(message)
+        app.process_input()
+    elapsed = time.perf_counter() - start
+    return {
+        'cc_per_second': len(messages) / elapsed,
+        'input_to_led_latency': summarize(app.input_to_led_latency),
+    }
+
+def bench_jitter(bpm):
+    restart_clock(bpm)
+    midi_out = app.midi_out
+    outport = stub_ports['output']
+    start_writes, start_steps, start_sysex = len(midi_out.serial_port.writes), steps[0], outport.sent_count
+    app.run_clock_loop(until=app.clock.get_time() + DURATION)
+    time.sleep(app.LOOKAHEAD + 0.01)
+
+    pulse_times = [at for at, data in midi_out.serial_port.writes[start_writes:] if app.MIDI_CLOCK in data]
+    pulse_intervals = [(b - a) * 1_000_000 for a, b in zip(pulse_times, pulse_times[1:])]
+    return {
+        'clock_lateness': summarize(app.clock.lateness),
+        'midi_output_lateness': summarize(app.histograms['midi_output_lateness']),
+        'pulse_interval_us': statistics.mean(pulse_intervals) if pulse_intervals else None,
+        'pulse_interval_stdev_us': statistics.pstdev(pulse_intervals) if pulse_intervals else None,
+        'led_sysex_per_step': (outport.sent_count - start_sysex) / max(steps[0] - start_steps, 1),
+    }
+
+class RecordingOutput:
+    # Stands in for the serial writer, which sends messages in timestamp order, same times in the order sent
+    def __init__(self):
+        self.messages = []
+
+    def send(self, data, at, histogram=None):
+        self.messages.append((at, data))
+
+    def flush(self):
+        pass
+
+    def get_sent(self):
+        return [data for at, data in sorted(self.messages, key=lambda message: message[0])]
+
+def check_note_order():
+    # Knob changes held back by coalescing go out from clock timers that run up to the lookahead early, their
+    # notes must still be sent on before off. Replaces the sequencer, so it runs after the benchmarks.
+    manual_time = ManualTime()
+    output = RecordingOutput()
+    midi_out, app.midi_out = app.midi_out, output
+    sequencer = app.create_sequencer(120, lookahead=0.02, get_time=manual_time, coalesce_window=0.01)
+    app.run_simulated_clock(manual_time, 0.6)
+    knob = sequencer.note_controllers[sequencer.current_step].cc_number
+    for value in range(0, 128, 4):
+        manual_time.advance(0.002)
+        app.queue_midi_message(mido.Message('control_change', channel=0, control=knob, value=value))
+        app.process_input()
+        app.clock.set_time()
+    app.run_simulated_clock(manual_time, manual_time() + 0.1)
+    app.midi_out = midi_out
+
+    sounding = set()
+    for data in output.get_sent():
+        message = mido.Message.from_bytes(data)
+        if message.type == 'note_on':
+            sounding.add(message.note)
+        elif message.type == 'note_off':
+            if message.note not in sounding:
+                raise AssertionError(f'note_off {message.note} was sent before its note_on')
+            sounding.remove(message.note)
+    if sounding:
+        raise AssertionError(f'Notes {sorted(sounding)} were left on')
+    return {'ok': True}
+
+def main():
+    wait_for_ports()
+    results = {
+        'throughput': bench_throughput(),
+        'cc_dispatch': bench_cc_dispatch(),
+        'jitter': {bpm: bench_jitter(bpm) for bpm in JITTER_BPMS},
+        'note_order': check_note_order(),
+    }
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'duration': DURATION,
+        'results': results,
+    }
+    with open(BENCH_OUTPUT, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import math
+
+class CoalescedOutput:
+    # Sends a step's output at most once per window. Requests made within the window only remember the
+    # step, when the window is over the step's latest values go out once and the requests in between are
+    # dropped. window is in seconds, or a function returning it so it can follow the tempo.
+    def __init__(self, clock, send, window=0):
+        self.clock = clock
+        self.send = send
+        self.window = window
+        self.pending_step = None
+        self.timer = None
+        self.last_sent_at = -math.inf
+        self.dropped_count = 0
+
+    def get_window(self):
+        return self.window() if callable(self.window) else self.window
+
+    def get_now(self):
+        # When output sent right now is due, which is ahead of the current time inside clock callbacks
+        return self.clock.get_event_context()[0]
+
+    def request(self, step):
+        now = self.get_now()
+        window = self.get_window()
+        if not self.clock.is_running:
+            # Timers don't run while the clock is stopped, nothing would send a held back value
+            self.pending_step = step
+            self.flush()
+            return
+
+        if self.timer is None and now - self.last_sent_at >= window:
+            self.last_sent_at = now
+            self.send(step)
+            return
+
+        if self.pending_step is not None:
+            self.dropped_count += 1
+        self.pending_step = step
+        if self.timer is None:
+            self.timer = self.clock.once_time(self.last_sent_at + window - self.clock.time, self.flush)
+
+    def flush(self):
+        # Called by the timer, or directly to send whatever is pending right away
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        step, self.pending_step = self.pending_step, None
+        if step is None:
+            return
+        self.last_sent_at = self.get_now()
+        self.send(step)
+
+    def cancel(self):
+        # Output was just sent without going through here, like on a step boundary, so whatever is
+        # pending is stale
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending_step is not None:
+            self.dropped_count += 1
+            self.pending_step = None
+        self.last_sent_at = self.get_now()
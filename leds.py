@@ -0,0 +1,50 @@
+import threading
+import mido
+
+# Launch Control XL "set LED" SysEx, followed by the template index and any number of LED index/color byte pairs
+LED_SYSEX_HEADER = [0, 32, 41, 2, 17, 120]
+LED_COUNT = 48
+
+class LedFrameBuffer:
+    def __init__(self, send):
+        self.send = send
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Last color byte sent for each LED of each template, None if unknown
+        self.shadow = {}
+
+    def set_led_color_byte(self, led_index, color_byte, template_index=0):
+        with self.lock:
+            self.pending.setdefault(template_index, {})[led_index] = color_byte
+
+    def refresh(self):
+        # Forget what the device shows, so the next flush resends every known LED
+        with self.lock:
+            for template_index, shadow in self.shadow.items():
+                pending = self.pending.setdefault(template_index, {})
+                for led_index, color_byte in enumerate(shadow):
+                    if color_byte is not None:
+                        pending.setdefault(led_index, color_byte)
+                self.shadow[template_index] = [None] * LED_COUNT
+
+    def flush(self):
+        if not self.pending:
+            return 0
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            messages = []
+            for template_index, color_bytes in pending.items():
+                shadow = self.shadow.setdefault(template_index, [None] * LED_COUNT)
+                data = LED_SYSEX_HEADER + [template_index]
+                for led_index, color_byte in color_bytes.items():
+                    if shadow[led_index] == color_byte:
+                        continue
+                    shadow[led_index] = color_byte
+                    data += (led_index, color_byte)
+                if len(data) > len(LED_SYSEX_HEADER) + 1:
+                    messages.append(mido.Message('sysex', data=data))
+
+        for message in messages:
+            self.send(message)
+        return len(messages)
@@ -0,0 +1,61 @@
+# Fixed-size log-linear histograms in the spirit of HdrHistogram. Recording a value is a couple of integer
+# operations and a list increment, cheap enough to leave on all the time.
+
+class Histogram:
+    def __init__(self, name, unit='us', sub_bucket_bits=5, max_value_bits=32):
+        self.name = name
+        self.unit = unit
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_value = (1 << max_value_bits) - 1
+        # Values below sub_bucket_count are counted exactly, every power of two above that gets sub_bucket_half buckets
+        self.counts = [0] * (self.sub_bucket_count + (max_value_bits - sub_bucket_bits) * self.sub_bucket_half)
+        self.count = 0
+        self.max = 0
+
+    def get_index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half + (value >> shift) - self.sub_bucket_half
+
+    def get_highest_value(self, index):
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.sub_bucket_count) // self.sub_bucket_half + 1
+        sub_bucket = (index - self.sub_bucket_count) % self.sub_bucket_half + self.sub_bucket_half
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value):
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self.get_index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile):
+        if self.count == 0:
+            return 0
+        target = max(self.count * percentile / 100, 1)
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= target:
+                return min(self.get_highest_value(index), self.max)
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.max = 0
+
+    def __str__(self):
+        return f'{self.name}: count={self.count} p50={self.get_percentile(50)}{self.unit} p99={self.get_percentile(99)}{self.unit} max={self.max}{self.unit}'
+
+histograms = {}
+
+def get_histogram(name, unit='us'):
+    if name not in histograms:
+        histograms[name] = Histogram(name, unit)
+    return histograms[name]
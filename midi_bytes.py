@@ -0,0 +1,18 @@
+# Prebuilt raw MIDI messages, so the output hot path neither builds nor validates mido.Message objects
+
+MIDI_CLOCK = b'\xf8'
+MIDI_START = b'\xfa'
+MIDI_CONTINUE = b'\xfb'
+MIDI_STOP = b'\xfc'
+
+def control_change_bytes(control: int, value: int, channel: int=0):
+    return bytes((0xB0 | channel, control, value))
+
+def control_change_table(control: int, channel: int=0):
+    return [control_change_bytes(control, value, channel) for value in range(128)]
+
+def note_on_table(velocity: int=127, channel: int=0):
+    return [bytes((0x90 | channel, note, velocity)) for note in range(128)]
+
+def note_off_table(velocity: int=127, channel: int=0):
+    return [bytes((0x80 | channel, note, velocity)) for note in range(128)]
@@ -0,0 +1,191 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from metrics import *
+from timesource import *
+
+# 31250 baud with a start and a stop bit per byte
+MIDI_BYTES_PER_SECOND = 31250 / 10
+
+class SerialMidiWriter(threading.Thread):
+    def __init__(self, serial_port, mergeable_controls=(), bytes_per_second=MIDI_BYTES_PER_SECOND, max_backlog=0.01, spin_time=0, get_time=monotonic_time):
+        super().__init__(daemon=True)
+        self.serial_port = serial_port
+        self.mergeable_controls = set(mergeable_controls)
+        self.bytes_per_second = bytes_per_second
+        self.max_backlog = max_backlog
+        self.spin_time = spin_time
+        # Has to be the clock's time source, messages are timestamped with it
+        self.get_time = get_time
+        self.on_start = []
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.batch = []
+
+        # How late messages are written compared to their timestamp
+        self.lateness = get_histogram('midi_output_lateness')
+
+        # Heap of (at, sequence, data, histogram) messages waiting for their time, only touched by the writer thread
+        self.scheduled = []
+        self.sequence = itertools.count()
+
+        # Only touched by the writer thread, it has to follow the bytes actually written
+        self.running_status = None
+        # When the link will be done sending everything written so far
+        self.link_free_at = 0
+        # Latest held back message for each mergeable (status, control)
+        self.pending_merges = {}
+
+        self.queued_bytes = 0
+        self.written_bytes = 0
+        self.dropped_bytes = 0
+        self.delayed_bytes = 0
+        self.failed_bytes = 0
+        self.reopen_interval = 1
+
+    def send(self, data: bytes, at: float, histogram=None):
+        with self.lock:
+            self.batch.append((at, data, histogram))
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        with self.lock:
+            batch, self.batch = self.batch, []
+        self.queue.put(batch)
+
+    def get_stats(self):
+        return {
+            'queued_bytes': self.queued_bytes,
+            'written_bytes': self.written_bytes,
+            'dropped_bytes': self.dropped_bytes,
+            'delayed_bytes': self.delayed_bytes,
+            'failed_bytes': self.failed_bytes,
+            'pending_merges': len(self.pending_merges),
+            'scheduled': len(self.scheduled),
+        }
+
+    def is_mergeable(self, data):
+        return data[0] & 0xF0 == 0xB0 and data[1] in self.mergeable_controls
+
+    def encode(self, batch):
+        encoded = bytearray()
+        for data in batch:
+            status = data[0]
+            if status >= 0xF8:
+                # Real-time messages may appear anywhere and leave running status alone
+                encoded += data
+            elif status >= 0xF0:
+                self.running_status = None
+                encoded += data
+            elif status == self.running_status:
+                encoded += data[1:]
+            else:
+                self.running_status = status
+                encoded += data
+        return encoded
+
+    def schedule(self, batch, now):
+        is_behind = self.link_free_at - now > self.max_backlog
+        if not is_behind and not self.pending_merges:
+            return batch
+
+        # The link is (or was) behind: real-time bytes go first, then gate, trigger and note edges,
+        # while mergeable CCs wait for the link to catch up and only their latest value is kept
+        scheduled = [data for data in batch if data[0] >= 0xF8]
+        for data in batch:
+            if data[0] >= 0xF8:
+                continue
+            if not self.is_mergeable(data):
+                scheduled.append(data)
+                continue
+            key = (data[0], data[1])
+            if key in self.pending_merges:
+                self.dropped_bytes += len(self.pending_merges[key])
+            self.pending_merges[key] = data
+
+        if not is_behind:
+            for data in self.pending_merges.values():
+                self.delayed_bytes += len(data)
+                scheduled.append(data)
+            self.pending_merges.clear()
+
+        return scheduled
+
+    def write(self, batch):
+        now = self.get_time()
+        encoded = self.encode(self.schedule(batch, now))
+        if not encoded:
+            return
+
+        try:
+            self.serial_port.write(encoded)
+        except Exception as e:
+            # The bytes are lost and the receiver's running status is unknown, keep going with a reopened port
+            print('MIDI output write failed:', e)
+            self.failed_bytes += len(encoded)
+            self.running_status = None
+            self.reopen()
+            return
+        self.written_bytes += len(encoded)
+        self.link_free_at = max(self.link_free_at, now) + len(encoded) / self.bytes_per_second
+
+    def reopen(self):
+        while True:
+            try:
+                self.serial_port.close()
+                self.serial_port.open()
+                print('Reopened MIDI output')
+                return
+            except Exception as e:
+                print('Failed to reopen MIDI output:', e)
+                time.sleep(self.reopen_interval)
+
+    def get_timeout(self):
+        timeout = None
+        if self.scheduled:
+            # Wake up a little early and spin the rest of the way
+            timeout = self.scheduled[0][0] - self.spin_time - self.get_time()
+        if self.pending_merges:
+            # Wake up once the link has caught up enough to take the held back messages
+            catch_up = self.link_free_at - self.max_backlog - self.get_time()
+            timeout = catch_up if timeout is None else min(timeout, catch_up)
+        return None if timeout is None else max(timeout, 0)
+
+    def run(self):
+        for callback in self.on_start:
+            callback()
+
+        while True:
+            try:
+                batch = self.queue.get(timeout=self.get_timeout())
+            except queue.Empty:
+                batch = []
+
+            while True:
+                try:
+                    batch += self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            for at, data, histogram in batch:
+                self.queued_bytes += len(data)
+                heapq.heappush(self.scheduled, (at, next(self.sequence), data, histogram or self.lateness))
+
+            if self.scheduled:
+                at = self.scheduled[0][0]
+                if at - self.get_time() <= self.spin_time:
+                    while self.get_time() < at:
+                        time.sleep(0)
+
+            # Everything due by now goes out in a single write
+            now = self.get_time()
+            due = []
+            while self.scheduled and self.scheduled[0][0] <= now:
+                at, _, data, histogram = heapq.heappop(self.scheduled)
+                histogram.record((now - at) * 1_000_000)
+                due.append(data)
+            self.write(due)
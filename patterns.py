@@ -0,0 +1,89 @@
+import mmap
+import os
+import struct
+import time
+from typing import NamedTuple
+
+# A pattern bank file is a header followed by one fixed-size record per pattern. Each record holds one byte
+# per step for the note, the three CVs, and the step and gate mode indexes.
+PATTERN_BANK_MAGIC = b'LCSP'
+PATTERN_BANK_VERSION = 1
+PATTERN_BANK_HEADER = struct.Struct('<4sBBBB')
+# Stands for a controller that hasn't been turned yet
+UNSET_VALUE = 0xFF
+
+class Pattern(NamedTuple):
+    notes: bytes
+    cv1: bytes
+    cv2: bytes
+    cv3: bytes
+    step_modes: bytes
+    gate_modes: bytes
+
+def empty_pattern(total_steps):
+    unset = bytes([UNSET_VALUE]) * total_steps
+    return Pattern(unset, unset, unset, unset, bytes(total_steps), bytes(total_steps))
+
+class PatternBank:
+    # Patterns are read from and written to a memory map, the OS writes them back to the file in its own time
+    def __init__(self, path, pattern_count=8, total_steps=16):
+        self.path = path
+        self.pattern_count = pattern_count
+        self.total_steps = total_steps
+        self.record = struct.Struct(f'{total_steps}s' * len(Pattern._fields))
+        size = PATTERN_BANK_HEADER.size + pattern_count * self.record.size
+
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not is_new and os.path.getsize(path) != size:
+            raise ValueError(f'{path} is {os.path.getsize(path)} bytes, a bank of {pattern_count} patterns with {total_steps} steps is {size}')
+
+        with open(path, 'a+b') as f:
+            if is_new:
+                f.truncate(size)
+            self.mmap = mmap.mmap(f.fileno(), size)
+
+        if is_new:
+            PATTERN_BANK_HEADER.pack_into(self.mmap, 0, PATTERN_BANK_MAGIC, PATTERN_BANK_VERSION, pattern_count, total_steps, 0)
+            for index in range(pattern_count):
+                self.save(index, empty_pattern(total_steps))
+        else:
+            magic, version, file_pattern_count, file_total_steps, _ = PATTERN_BANK_HEADER.unpack_from(self.mmap, 0)
+            if (magic, version, file_pattern_count, file_total_steps) != (PATTERN_BANK_MAGIC, PATTERN_BANK_VERSION, pattern_count, total_steps):
+                self.mmap.close()
+                raise ValueError(f'{path} is not a pattern bank of {pattern_count} patterns with {total_steps} steps')
+
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            # Read the whole bank in now rather than on the first switch
+            self.mmap.madvise(mmap.MADV_WILLNEED)
+
+    def get_offset(self, index):
+        return PATTERN_BANK_HEADER.size + index * self.record.size
+
+    def load(self, index) -> Pattern:
+        return Pattern(*self.record.unpack_from(self.mmap, self.get_offset(index)))
+
+    def save(self, index, pattern: Pattern):
+        self.record.pack_into(self.mmap, self.get_offset(index), *pattern)
+
+    def get_current_index(self):
+        index = PATTERN_BANK_HEADER.unpack_from(self.mmap, 0)[4]
+        return index if index < self.pattern_count else 0
+
+    def set_current_index(self, index):
+        struct.pack_into('<B', self.mmap, PATTERN_BANK_HEADER.size - 1, index)
+
+def open_pattern_bank(path, pattern_count=8, total_steps=16):
+    try:
+        return PatternBank(path, pattern_count, total_steps)
+    except (OSError, ValueError) as e:
+        print('Failed to open pattern bank:', e)
+
+    # A damaged or outdated bank is kept next to the new one rather than overwritten
+    aside_path = f'{path}.{int(time.time())}.bad'
+    try:
+        os.replace(path, aside_path)
+        print('Moved', path, 'to', aside_path)
+        return PatternBank(path, pattern_count, total_steps)
+    except (OSError, ValueError) as e:
+        print('Running without a pattern bank:', e)
+        return None
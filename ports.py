@@ -0,0 +1,102 @@
+import threading
+import mido
+
+class PortManager(threading.Thread):
+    def __init__(self, partial_input_name, partial_output_name, callback, check_interval=2, min_backoff=0.5, max_backoff=8):
+        super().__init__(daemon=True)
+        self.partial_input_name = partial_input_name
+        self.partial_output_name = partial_output_name
+        self.callback = callback
+        self.check_interval = check_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.on_connect = []
+        self.wakeup = threading.Event()
+        self.dropped_count = 0
+
+        # (inport, outport) while the device is connected, otherwise None. Only
+        # ever replaced as a whole, so senders can read it without locking.
+        self.ports = None
+        # Ports opened by this thread, which is the only one closing them
+        self.opened_ports = None
+
+    def send(self, message: mido.Message):
+        ports = self.ports
+        if ports is None:
+            self.dropped_count += 1
+            return
+
+        try:
+            ports[1].send(message)
+        except Exception as e:
+            print(e)
+            self.ports = None
+            self.wakeup.set()
+
+    def get_port_names(self):
+        try:
+            return mido.get_input_names(), mido.get_output_names()
+        except Exception as e:
+            print('Failed to get ports')
+            return [], []
+
+    def is_connected(self):
+        input_port_names, output_port_names = self.get_port_names()
+        inport, outport = self.opened_ports
+        return inport.name in input_port_names and outport.name in output_port_names
+
+    def open_ports(self):
+        input_port_names, output_port_names = self.get_port_names()
+        input_port_name = next((name for name in input_port_names if self.partial_input_name in name), None)
+        output_port_name = next((name for name in output_port_names if self.partial_output_name in name), None)
+        if input_port_name is None or output_port_name is None:
+            return False
+
+        inport = None
+        try:
+            inport = mido.open_input(input_port_name, callback=self.callback)
+            print('Opened MIDI input', inport.name)
+            outport = mido.open_output(output_port_name)
+            print('Opened MIDI output', outport.name)
+        except Exception as e:
+            print(e)
+            # Left open, the next attempt would add a second input calling the callback for every message
+            if inport is not None:
+                print('Closing MIDI input', inport.name)
+                inport.close()
+            return False
+
+        self.opened_ports = (inport, outport)
+        self.ports = self.opened_ports
+        for callback in self.on_connect:
+            callback()
+        return True
+
+    def close_ports(self):
+        self.ports = None
+        if self.opened_ports is None:
+            return
+
+        inport, outport = self.opened_ports
+        self.opened_ports = None
+        print('Closing MIDI input', inport.name)
+        inport.close()
+        print('Closing MIDI output', outport.name)
+        outport.close()
+
+    def run(self):
+        backoff = self.min_backoff
+        while True:
+            self.wakeup.clear()
+
+            if self.ports is not None and self.is_connected():
+                self.wakeup.wait(self.check_interval)
+                continue
+
+            self.close_ports()
+            if self.open_ports():
+                backoff = self.min_backoff
+                continue
+
+            self.wakeup.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,41 @@
+import ctypes
+import ctypes.util
+import os
+import threading
+
+# Inside a container this needs e.g. `--cap-add SYS_NICE --ulimit rtprio=99 --ulimit memlock=-1`, running as root alone is not enough
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+def lock_memory():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    except (AttributeError, OSError) as e:
+        print('Could not lock memory:', e)
+        return False
+
+    print('Locked memory')
+    return True
+
+def enable_realtime(name, priority, cpu=None):
+    # Scheduling policy and affinity are per thread on Linux, so this only affects the calling thread
+    thread_id = threading.get_native_id()
+
+    try:
+        os.sched_setscheduler(thread_id, os.SCHED_FIFO, os.sched_param(priority))
+        print(f'Running {name} thread with SCHED_FIFO priority {priority}')
+    except (AttributeError, OSError) as e:
+        print(f'Could not set real-time priority for {name} thread:', e)
+
+    if cpu is None:
+        return
+
+    try:
+        os.sched_setaffinity(thread_id, {cpu})
+        print(f'Pinned {name} thread to CPU {cpu}')
+    except (AttributeError, OSError) as e:
+        print(f'Could not pin {name} thread to CPU {cpu}:', e)
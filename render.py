@@ -0,0 +1,120 @@
+import argparse
+import os
+import time
+import mido
+import app
+from patterns import PatternBank
+from snapshots import load_snapshot
+from timesource import ManualTime
+
+# Renders bars of the current pattern to a MIDI file as fast as the CPU allows, driving the clock from a
+# virtual timebase instead of the wall clock, e.g. `python render.py pattern.mid 8 --pattern 2`
+
+TICKS_PER_BEAT = 480
+BEATS_PER_BAR = 4
+
+class MidiRecorder:
+    # Takes the place of the serial writer and keeps every message with the time it is due at
+    def __init__(self):
+        self.messages = []
+
+    def send(self, data: bytes, at: float, histogram=None):
+        self.messages.append((at, data))
+
+    def flush(self):
+        pass
+
+def to_tick(at, start, interval):
+    return round((at - start) / interval * TICKS_PER_BEAT)
+
+def to_midi_file(messages, start, bpm):
+    interval = 60 / bpm
+    midi_file = mido.MidiFile(ticks_per_beat=TICKS_PER_BEAT)
+    track = midi_file.add_track('Sequencer')
+    # MIDI files can't hold real-time messages, so clock and transport bytes go to their own track as
+    # sequencer specific meta events, at the exact tick they were sent at
+    clock_track = midi_file.add_track('Clock')
+    track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm)))
+
+    last_ticks = {id(track): 0, id(clock_track): 0}
+    # Sorting is stable, so messages due at the same time keep the order they were sent in
+    for at, data in sorted(messages, key=lambda message: message[0]):
+        tick = to_tick(at, start, interval)
+        if data[0] >= 0xF8:
+            target = clock_track
+            message = mido.MetaMessage('sequencer_specific', data=list(data))
+        else:
+            target = track
+            message = mido.Message.from_bytes(data)
+        message.time = tick - last_ticks[id(target)]
+        last_ticks[id(target)] = tick
+        target.append(message)
+    return midi_file
+
+def render(bars, bpm=app.BPM, setup=None):
+    manual_time = ManualTime()
+    recorder = MidiRecorder()
+
+    # Events run exactly when they are due, there is no real output to get ahead of
+    app.midi_out = recorder
+    sequencer = app.create_sequencer(bpm, lookahead=0, get_time=manual_time)
+    clock = sequencer.clock
+    start = clock.time
+
+    if setup is not None:
+        # Setting up the pattern isn't part of the performance, neither is anything it scheduled for now
+        app.midi_out = None
+        setup(sequencer)
+        sequencer.note_output.cancel()
+        sequencer.cv_output.cancel()
+        clock.set_time()
+        app.midi_out = recorder
+
+    app.run_simulated_clock(manual_time, until=start + bars * BEATS_PER_BAR * clock.interval)
+
+    app.midi_out = None
+    return to_midi_file(recorder.messages, start, clock.bpm)
+
+def load_current_pattern(pattern_index=None):
+    # The pattern the sequencer would play: the saved state, or else the bank's current pattern. With
+    # pattern_index, that pattern of the bank instead.
+    def setup(sequencer):
+        snapshot = load_snapshot(app.STATE_PATH) if pattern_index is None else None
+        if snapshot is not None:
+            sequencer.restore_snapshot(snapshot)
+            print('Rendering the state saved in', app.STATE_PATH)
+            return
+
+        if not os.path.exists(app.PATTERN_BANK_PATH):
+            if pattern_index is not None:
+                raise ValueError(f'There is no pattern bank at {app.PATTERN_BANK_PATH}')
+            print('No saved state or pattern bank, rendering an empty pattern')
+            return
+
+        pattern_bank = PatternBank(app.PATTERN_BANK_PATH, app.PATTERN_COUNT, app.TOTAL_STEPS)
+        index = pattern_bank.get_current_index() if pattern_index is None else pattern_index
+        if not 0 <= index < pattern_bank.pattern_count:
+            raise ValueError(f'Pattern {index} is not in the bank, it has {pattern_bank.pattern_count} patterns')
+        sequencer.set_pattern(pattern_bank.load(index))
+        print(f'Rendering pattern {index} of {app.PATTERN_BANK_PATH}')
+    return setup
+
+def main():
+    parser = argparse.ArgumentParser(description='Render bars of the current pattern to a MIDI file')
+    parser.add_argument('output', help='MIDI file to write')
+    parser.add_argument('bars', type=int, nargs='?', default=4)
+    parser.add_argument('--pattern', type=int, help='index of the pattern bank pattern to render instead of the saved state')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        midi_file = render(args.bars, setup=load_current_pattern(args.pattern))
+    except (KeyError, TypeError, ValueError) as e:
+        parser.error(f'Failed to load the pattern: {e}')
+    elapsed = time.perf_counter() - start
+    midi_file.save(args.output)
+    bpm = mido.tempo2bpm(midi_file.tracks[0][1].tempo)
+    print(f'Rendered {args.bars} bars at {bpm:g} BPM to {args.output} in {elapsed * 1000:.1f} ms')
+
+if __name__ == '__main__':
+    main()
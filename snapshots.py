@@ -0,0 +1,66 @@
+import json
+import os
+import queue
+import threading
+import time
+
+class SnapshotWriter(threading.Thread):
+    # Every interval this thread asks the clock loop for a snapshot of the sequencer state through
+    # request_snapshot, the loop hands it over from poll() and the thread writes it out. The file is
+    # replaced atomically, a crash mid-write leaves the previous snapshot in place.
+    def __init__(self, path, get_snapshot, request_snapshot, interval=1):
+        super().__init__(daemon=True)
+        self.path = path
+        self.get_snapshot = get_snapshot
+        self.request_snapshot = request_snapshot
+        self.interval = interval
+        self.is_due = False
+        self.queue = queue.SimpleQueue()
+        self.last_snapshot = None
+        self.written_count = 0
+
+    def poll(self):
+        # Called by the clock loop, the only thread that may read the state
+        if not self.is_due:
+            return
+        self.is_due = False
+
+        snapshot = self.get_snapshot()
+        if snapshot == self.last_snapshot:
+            snapshot = None
+        else:
+            self.last_snapshot = snapshot
+        self.queue.put(snapshot)
+
+    def write(self, snapshot):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.written_count += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.is_due = True
+            self.request_snapshot()
+
+            snapshot = self.queue.get()
+            if snapshot is None:
+                continue
+            try:
+                self.write(snapshot)
+            except OSError as e:
+                print('Failed to write snapshot', e)
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print('Failed to load snapshot', e)
+        return None
@@ -0,0 +1,22 @@
+import time
+
+# Time sources are called with no arguments and return the current time in seconds. Everything that compares
+# timestamps with each other (the clock, the MIDI output writer, input latency) has to use the same one.
+
+def monotonic_time():
+    # Unaffected by NTP and wall clock adjustments, with nanosecond resolution
+    return time.perf_counter_ns() / 1_000_000_000
+
+class ManualTime:
+    # Only moves when told to, so a simulation can jump straight from one deadline to the next
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def set(self, now):
+        self.now = now
+
+    def advance(self, seconds):
+        self.now += seconds